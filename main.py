@@ -1,22 +1,33 @@
 from fastapi import FastAPI, Request
-import io
-import json
+import asyncio
+import orjson
+import os
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
 from urllib.parse import quote
 from fastapi.templating import Jinja2Templates
-from fastapi import APIRouter, File, Form, HTTPException, Request, UploadFile
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from fastapi import APIRouter, BackgroundTasks, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, StreamingResponse
-from base64 import b64encode
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
 from pathlib import Path
 from fastapi.staticfiles import StaticFiles
+from starlette.background import BackgroundTask
 
+import storage
 from logger import get_logger
 from middleware import SessionMiddleware
 from utils import (
-    combine_archives,
+    OUTPUT_MODES,
+    QueueStream,
     convert_and_pack,
     convert_pdf_to_images,
     get_files_from_session,
+    get_process_pool,
+    restart_process_pool,
+    shutdown_process_pool,
+    start_process_pool,
     merge_pdfs,
     rotate_pages_in_pdf,
     split_pdf,
@@ -25,7 +36,18 @@ from vizit import send_visit_info
 
 logger = get_logger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Пул создается один раз при старте, а не лениво из рабочего потока запроса
+    start_process_pool()
+    try:
+        yield
+    finally:
+        shutdown_process_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(SessionMiddleware)
 
 ORIGINS="http://localhost:3000,http://127.0.0.1:3000,http://45.80.71.178:3000,http://45.80.71.178,http://45.80.71.178:80,http://www.memovoz.store,http://memovoz.store,http://www.memovoz.ru,http://memovoz.ru,https://www.memovoz.ru,https://memovoz.ru,https://memovoz.ru/"
@@ -37,26 +59,109 @@ app.add_middleware(
     allow_methods=["GET", "POST", "OPTIONS", "DELETE", "PATCH", "PUT"],
     allow_headers=["*"],
 )
-templates = Jinja2Templates(directory=str(Path(__file__).parent / "templates"))
-templates.env.filters["b64encode"] = lambda x: b64encode(x).decode("utf-8")
+templates = Jinja2Templates(
+    env=Environment(
+        loader=FileSystemLoader(Path(__file__).parent / "templates"),
+        autoescape=True,
+        # Каталог по умолчанию создается для текущего пользователя с правами 0700
+        # и проверяется на владельца: чужой байткод из общего /tmp не загрузится
+        bytecode_cache=FileSystemBytecodeCache(),
+    )
+)
+# Шаблоны страниц компилируются один раз при старте, на запрос остается только render
+page_templates = {
+    name: templates.get_template(name) for name in ("index.html", "split.html", "merge.html", "convert.html")
+}
+
+
+def render_page(name: str, request: Request) -> HTMLResponse:
+    return HTMLResponse(page_templates[name].render(request=request, session=request.state.session))
 
 STATIC_DIR = "static"
 STATIC_URL = "static"
 app.mount("/static", StaticFiles(directory=STATIC_DIR), STATIC_URL)
 
 
+class CachedStaticFiles(StaticFiles):
+    """Статика с Cache-Control: превью адресуются по хешу и не меняются"""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=3600"
+        return response
+
+
+storage.PREVIEWS_DIR.mkdir(parents=True, exist_ok=True)
+app.mount(storage.PREVIEWS_URL, CachedStaticFiles(directory=storage.PREVIEWS_DIR), "previews")
+
+# Ограничивает число одновременно выполняемых тяжелых операций с PDF
+pdf_tasks_limit = asyncio.Semaphore(os.cpu_count() or 1)
+# Потоки, пишущие архивы для скачивания: они ждут клиентов, а не CPU,
+# поэтому у них отдельный лимит и они не занимают общий пул потоков asyncio
+MAX_ARCHIVE_STREAMS = 32
+archive_executor = ThreadPoolExecutor(max_workers=MAX_ARCHIVE_STREAMS, thread_name_prefix="archive")
+
+
+async def run_blocking(func, *args, in_process: bool = True):
+    """
+    Выполняет синхронную работу с PDF вне event loop
+    :param func: Синхронная функция из utils
+    :param in_process: Выполнять в пуле процессов; False - в потоке (для функций,
+                       которые сами раздают страницы в пул процессов)
+    :return: Результат func
+    """
+    loop = asyncio.get_running_loop()
+    async with pdf_tasks_limit:
+        executor = get_process_pool() if in_process else None
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            logger.error(f"Process pool is broken while running {func.__name__}, restarting it")
+            restart_process_pool(executor)
+            raise HTTPException(status_code=503, detail="Сервис временно недоступен, повторите попытку")
+
+
+async def stream_converted_archive(requested_files: dict, dpi: int, output_mode: str):
+    """
+    Отдает ZIP-архив с JPEG по мере рендеринга страниц
+    :param requested_files: Словарь {имя_файла: путь_к_файлу}
+    :param dpi: Разрешение изображений
+    :param output_mode: Режим конвертации из OUTPUT_MODES
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=8)
+    stream = QueueStream(queue, loop)
+
+    def produce():
+        with stream:
+            convert_and_pack(requested_files, stream, dpi, output_mode)
+
+    def retrieve_exception(future: asyncio.Future) -> None:
+        # После отключения клиента результат производителя никто не ждет;
+        # забираем исключение, чтобы asyncio не писал его в лог как необработанное
+        if not future.cancelled():
+            future.exception()
+
+    # Не через run_blocking: производитель может долго ждать медленного клиента,
+    # и занимать при этом слот pdf_tasks_limit нельзя. Сам рендеринг ограничен
+    # размером пула процессов
+    producer = loop.run_in_executor(archive_executor, produce)
+    producer.add_done_callback(retrieve_exception)
+    try:
+        while (chunk := await queue.get()) is not None:
+            yield chunk
+        await producer
+    finally:
+        # Если клиент отключился, поток-производитель не должен ждать места в очереди
+        stream.cancel()
+
+
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
+async def home(request: Request, background_tasks: BackgroundTasks):
     logger.info("Handling request for home page")
-    send_visit_info(request, logger)
+    background_tasks.add_task(send_visit_info, request, logger)
     try:
-        response = templates.TemplateResponse(
-            "index.html",
-            {
-                "request": request,
-                "session": request.state.session,
-            },
-        )
+        response = render_page("index.html", request)
         logger.info("Successfully rendered home page")
         return response
     except Exception as e:
@@ -73,16 +178,24 @@ async def upload_pdf(request: Request, file: UploadFile = File(...)):
 
     try:
         content = await file.read()
-        memory_file = io.BytesIO(content)
-
-        logger.debug("Converting PDF to images for preview")
-        file_previews = convert_pdf_to_images(memory_file.getvalue())
+        file_sha = await run_blocking(storage.save_pdf, content, in_process=False)
+        del content  # Дальше PDF читается только из хранилища
+
+        preview_urls = storage.get_cached_previews(file_sha)
+        if preview_urls is None:
+            logger.debug("Converting PDF to images for preview")
+            file_previews = await run_blocking(convert_pdf_to_images, storage.pdf_path(file_sha), in_process=False)
+            preview_urls = await run_blocking(storage.save_previews, file_previews, in_process=False)
+            storage.cache_previews(file_sha, preview_urls)
+        else:
+            logger.debug(f"Using cached previews for {file_sha}")
         filename = file.filename
 
+        # В сессии только метаданные, сами файлы лежат в хранилище
         new_file = {
             "filename": filename,
-            "file_content": memory_file.getvalue(),
-            "file_previews": file_previews,
+            "sha": file_sha,
+            "preview_urls": preview_urls,
         }
 
         files = request.state.session.get("files", {})
@@ -90,13 +203,9 @@ async def upload_pdf(request: Request, file: UploadFile = File(...)):
         request.state.session["files"] = files
         logger.info(f"Successfully uploaded and processed file: {filename}")
 
-        return templates.TemplateResponse(
-            "index.html",
-            {
-                "request": request,
-                "session": request.state.session,
-            },
-        )
+        return render_page("index.html", request)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error processing uploaded file {file.filename}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -106,13 +215,7 @@ async def upload_pdf(request: Request, file: UploadFile = File(...)):
 async def split_page(request: Request):
     logger.info("Handling request for split page")
     try:
-        response = templates.TemplateResponse(
-            "split.html",
-            {
-                "request": request,
-                "session": request.state.session,
-            },
-        )
+        response = render_page("split.html", request)
         logger.info("Successfully rendered split page")
         return response
     except Exception as e:
@@ -140,40 +243,35 @@ async def split_pdf_page(
         raise HTTPException(status_code=400, detail="Запрошенный файл не найден в сессии")
 
     file_data = files[original_filename]
-    file_content = file_data.get("file_content")
-    if not file_content:
+    file_path = storage.pdf_path(file_data["sha"]) if file_data.get("sha") else None
+    if not file_path or not file_path.exists():
         logger.warning(f"No content found for file: {original_filename}")
         raise HTTPException(status_code=400, detail="Отсутствует содержимое PDF файла")
 
     try:
         logger.debug(f"Attempting to split PDF with pages: {pages}")
-        output_stream = split_pdf(file_content, pages)
+        output_path = await run_blocking(split_pdf, file_path, pages)
         logger.info(f"Successfully split PDF: {original_filename}")
 
-        return StreamingResponse(
-            output_stream,
+        return FileResponse(
+            output_path,
             headers={"Content-Disposition": f"attachment; filename={quote(output_name)}"},
             media_type="application/pdf",
+            background=BackgroundTask(output_path.unlink, missing_ok=True),
         )
     except HTTPException as he:
         logger.error(f"HTTP error during PDF split: {str(he)}")
         raise he
     except Exception as e:
         logger.error(f"Error splitting PDF: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+        raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера")
 
 
 @app.get("/merge", response_class=HTMLResponse)
 async def merge_page(request: Request):
     logger.info("Handling request for merge page")
     try:
-        response = templates.TemplateResponse(
-            "merge.html",
-            {
-                "request": request,
-                "session": request.state.session,
-            },
-        )
+        response = render_page("merge.html", request)
         logger.info("Successfully rendered merge page")
         return response
     except Exception as e:
@@ -188,14 +286,18 @@ async def merge_pdfs_page(request: Request, filenames: list = Form(...), output_
         session_files = request.state.session.get("files", [])
         logger.debug(f"Found {len(session_files)} files in session")
 
-        merged_bytes = merge_pdfs(filenames, session_files)
+        requested_files = {f: session_files[f] for f in filenames if f in session_files}
+        output_path = await run_blocking(merge_pdfs, filenames, requested_files)
         logger.info(f"Successfully merged {len(filenames)} PDFs into {output_name}")
 
-        return StreamingResponse(
-            merged_bytes,
+        return FileResponse(
+            output_path,
             media_type="application/pdf",
             headers={"Content-Disposition": f"attachment; filename={output_name}"},
+            background=BackgroundTask(output_path.unlink, missing_ok=True),
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error merging PDFs: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -205,13 +307,7 @@ async def merge_pdfs_page(request: Request, filenames: list = Form(...), output_
 async def convert_page(request: Request):
     logger.info("Handling request for convert page")
     try:
-        response = templates.TemplateResponse(
-            "convert.html",
-            {
-                "request": request,
-                "session": request.state.session,
-            },
-        )
+        response = render_page("convert.html", request)
         logger.info("Successfully rendered convert page")
         return response
     except Exception as e:
@@ -224,27 +320,25 @@ async def convert_pdf_to_jpg(
         request: Request,
         filenames: list = Form(...),
         dpi: int = Form(300),
+        output_mode: str = Form("print"),
         output_name: str = Form("converted"),
 ):
-    logger.info(f"Starting PDF to JPG conversion for files: {filenames}, DPI: {dpi}")
+    logger.info(f"Starting PDF to JPG conversion for files: {filenames}, DPI: {dpi}, mode: {output_mode}")
     try:
+        if output_mode not in OUTPUT_MODES:
+            logger.warning(f"Unknown output mode: {output_mode}")
+            raise HTTPException(status_code=400, detail="Некорректный режим конвертации")
+
         requested_files = get_files_from_session(request, filenames)
         logger.debug(f"Found {len(requested_files)} requested files in session")
 
-        individual_archives = []
-        for filename, file_content in requested_files.items():
-            logger.debug(f"Processing file: {filename}")
-            individual_archive = convert_and_pack(filename, file_content, dpi)
-            individual_archives.append(individual_archive)
-
-        combined_archive = combine_archives(individual_archives)
-        logger.info(f"Successfully converted and packed {len(filenames)} PDFs to JPG")
-
         return StreamingResponse(
-            combined_archive,
+            stream_converted_archive(requested_files, dpi, output_mode),
             media_type="application/zip",
             headers={"Content-Disposition": f"attachment; filename={output_name}.zip"},
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error converting PDF to JPG: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -275,16 +369,16 @@ async def rotate_pdf_pages(
     """
     Обрабатывает запрос на поворот страниц PDF
     """
-    logger.info(f"Starting PDF rotation for file: {original_filename}, pages_and_angles: {pages_and_angles}")
+    logger.info(f"Starting PDF rotation for file: {original_filename}")
 
     if not pages_and_angles or pages_and_angles.strip() == "":
         logger.warning("No pages_and_angles provided for rotation")
         raise HTTPException(status_code=400, detail="Необходимо выбрать страницы и установить углы поворота.")
 
     try:
-        pages_and_angles_dict = json.loads(pages_and_angles)
-        logger.debug(f"Parsed rotation data: {pages_and_angles_dict}")
-    except json.JSONDecodeError:
+        pages_and_angles_dict = orjson.loads(pages_and_angles)
+        logger.debug("Parsed rotation data: %s", pages_and_angles_dict)
+    except orjson.JSONDecodeError:
         logger.error("Invalid JSON format for pages_and_angles")
         raise HTTPException(status_code=400, detail="Неправильный формат JSON")
 
@@ -296,23 +390,30 @@ async def rotate_pdf_pages(
         raise HTTPException(status_code=400, detail="Запрошенный файл не найден в сессии")
 
     file_data = files[original_filename]
-    file_content = file_data.get("file_content")
-    if not file_content:
+    file_path = storage.pdf_path(file_data["sha"]) if file_data.get("sha") else None
+    if not file_path or not file_path.exists():
         logger.warning(f"No content found for file: {original_filename}")
         raise HTTPException(status_code=400, detail="Отсутствует содержимое PDF файла")
 
     try:
         rotations = [(int(page), angle) for page, angle in pages_and_angles_dict.items() if angle != 0]
-        logger.debug(f"Prepared rotations: {rotations}")
+        logger.debug("Prepared rotations: %s", rotations)
+    except (AttributeError, ValueError):
+        logger.error("Invalid page numbers in pages_and_angles")
+        raise HTTPException(status_code=400, detail="Неправильный формат JSON")
 
-        rotated_pdf = rotate_pages_in_pdf(file_content, rotations)
+    try:
+        output_path = await run_blocking(rotate_pages_in_pdf, file_path, rotations)
         logger.info(f"Successfully rotated PDF: {original_filename}")
 
-        return StreamingResponse(
-            rotated_pdf,
+        return FileResponse(
+            output_path,
             headers={"Content-Disposition": f"attachment; filename={output_name}"},
             media_type="application/pdf",
+            background=BackgroundTask(output_path.unlink, missing_ok=True),
         )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error rotating PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
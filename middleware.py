@@ -1,34 +1,120 @@
 from starlette.middleware.base import BaseHTTPMiddleware
+import asyncio
+import os
 import uuid
+import weakref
+from contextlib import asynccontextmanager, suppress
+from typing import Optional
+
+import msgpack
+from cachetools import TTLCache
 from fastapi import Request
+from redis import asyncio as aioredis
+
+from storage import PREVIEWS_URL
+
+SESSION_TTL = 15 * 60
+# Сессия хранит только метаданные файлов, поэтому лимит большой: при переполнении
+# TTLCache вытесняет сессии пользователей вместе с их загруженными файлами
+SESSIONS_MAXSIZE = 100_000
+REDIS_URL = os.getenv("REDIS_URL")
+# Сессии в Redis видны всем подам, а файлы, на которые они ссылаются, лежат
+# в хранилище на диске: без общего хранилища другие поды не найдут загрузки
+if REDIS_URL and not os.getenv("PDF_STORAGE_DIR"):
+    raise RuntimeError("REDIS_URL requires PDF_STORAGE_DIR pointing to storage shared by all workers")
+# Блокировка сессии в Redis продлевается, пока запрос выполняется,
+# и снимается сама через это время, если держащий ее процесс упал
+SESSION_LOCK_TIMEOUT = 30
+# Статике сессия не нужна, и превью не должны ждать блокировку сессии
+SESSIONLESS_PATHS = ("/static", PREVIEWS_URL)
+
+
+class MemorySessionStore:
+    """Сессии в памяти процесса с ограничением по количеству и времени жизни"""
+
+    def __init__(self):
+        self.sessions = TTLCache(maxsize=SESSIONS_MAXSIZE, ttl=SESSION_TTL)
+        # Блокировка живет, пока ее держит или ждет хотя бы один запрос
+        self.locks = weakref.WeakValueDictionary()
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        lock = self.locks.get(session_id)
+        if lock is None:
+            lock = self.locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def load(self, session_id: str) -> Optional[dict]:
+        return self.sessions.get(session_id)
+
+    async def save(self, session_id: str, session: dict) -> None:
+        # Повторная запись продлевает время жизни сессии
+        self.sessions[session_id] = session
+
+
+class RedisSessionStore:
+    """Сессии в Redis, общие для всех процессов и подов; байты хранятся в msgpack как есть, без base64"""
 
-user_sessions = {}
+    def __init__(self, url: str):
+        self.redis = aioredis.from_url(url)
+
+    @asynccontextmanager
+    async def lock(self, session_id: str):
+        # Распределенная блокировка через SET NX, общая для всех процессов
+        lock = self.redis.lock(f"lock:sess:{session_id}", timeout=SESSION_LOCK_TIMEOUT)
+        async with lock:
+            renewal = asyncio.create_task(self._keep_lock(lock))
+            try:
+                yield
+            finally:
+                renewal.cancel()
+                with suppress(asyncio.CancelledError):
+                    await renewal
+
+    @staticmethod
+    async def _keep_lock(lock) -> None:
+        """Продлевает блокировку, чтобы долгий запрос (рендеринг превью) не потерял ее на середине"""
+        while True:
+            await asyncio.sleep(SESSION_LOCK_TIMEOUT / 3)
+            await lock.reacquire()
+
+    async def load(self, session_id: str) -> Optional[dict]:
+        raw = await self.redis.get(f"sess:{session_id}")
+        return msgpack.unpackb(raw, raw=False) if raw is not None else None
+
+    async def save(self, session_id: str, session: dict) -> None:
+        await self.redis.set(f"sess:{session_id}", msgpack.packb(session, use_bin_type=True), ex=SESSION_TTL)
+
+
+session_store = RedisSessionStore(REDIS_URL) if REDIS_URL else MemorySessionStore()
 
 
 class SessionMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        session_id = request.cookies.get("session_id")
-        if session_id in user_sessions:
-            request.state.session = user_sessions[session_id]
-        elif session_id is None:
-            new_session_id = str(uuid.uuid4())
-            request.state.session = {}
-            user_sessions[new_session_id] = request.state.session
-            session_id = new_session_id
-        else:
-            request.state.session = {}
-            user_sessions[session_id] = request.state.session
-
-        response = await call_next(request)
-
-        if request.cookies.get("session_id") is None:
-            cookie_life = 15 * 60
+        if request.url.path.startswith(SESSIONLESS_PATHS):
+            return await call_next(request)
+
+        session_id = request.cookies.get("session_id") or str(uuid.uuid4())
+
+        # Запросы одной сессии выполняются по очереди, чтобы не терять изменения друг друга
+        async with session_store.lock(session_id):
+            session = await session_store.load(session_id)
+            is_new = session is None
+            request.state.session = {} if is_new else session
+
+            try:
+                response = await call_next(request)
+            finally:
+                # Пустые новые сессии (боты, первый заход без загрузки) не сохраняем
+                saved = not is_new or bool(request.state.session)
+                if saved:
+                    await session_store.save(session_id, request.state.session)
+
+        if request.cookies.get("session_id") is None and saved:
             response.set_cookie(
                 key="session_id",
                 value=session_id,
                 httponly=True,
-                max_age=cookie_life,
+                max_age=SESSION_TTL,
             )
 
         return response
-
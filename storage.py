@@ -0,0 +1,161 @@
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from cachetools import LRUCache
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def _private_temp_dir() -> Path:
+    """
+    Каталог хранилища по умолчанию: свой для пользователя, с правами 0700.
+    Каталог в общем /tmp, заранее созданный другим пользователем, не используется:
+    в нем можно подменить PDF и превью, которым save_blob доверяет по имени.
+    """
+    path = Path(tempfile.gettempdir()) / f"pdf-converter-{os.getuid()}"
+    try:
+        path.mkdir(mode=stat.S_IRWXU)
+    except FileExistsError:
+        pass
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise RuntimeError(f"Storage directory {path} is not a directory owned by the current user")
+    if stat.S_IMODE(info.st_mode) != stat.S_IRWXU:
+        os.chmod(path, stat.S_IRWXU)
+    return path
+
+
+# Если сессии хранятся в Redis, PDF_STORAGE_DIR должен указывать на хранилище,
+# общее для всех процессов и подов (см. middleware)
+STORAGE_DIR = Path(os.environ["PDF_STORAGE_DIR"]) if os.getenv("PDF_STORAGE_DIR") else _private_temp_dir()
+# Превью лежат отдельно: этот каталог целиком раздается как статика
+PREVIEWS_DIR = STORAGE_DIR / "previews"
+PREVIEWS_URL = "/previews"
+# Результаты операций: удаляются после отправки клиенту
+OUTPUT_DIR = STORAGE_DIR / "output"
+# Сессии живут 15 минут, поэтому файлы старше часа уже никому не нужны
+STORAGE_TTL = 60 * 60
+CLEANUP_INTERVAL = 5 * 60
+
+_last_cleanup = 0.0
+
+# URL превью по хешу PDF: повторная загрузка того же файла не рендерит страницы заново
+_previews_cache = LRUCache(maxsize=256)
+_previews_cache_lock = threading.Lock()
+
+
+def pdf_path(sha: str) -> Path:
+    """Путь к PDF в хранилище по хешу содержимого"""
+    return STORAGE_DIR / f"{sha}.pdf"
+
+
+def new_output_path(suffix: str) -> Path:
+    """Путь для временного файла с результатом операции"""
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    return OUTPUT_DIR / f"{uuid.uuid4().hex}{suffix}"
+
+
+def link_output(path: Path, suffix: str) -> Path:
+    """
+    Отдает файл хранилища как результат операции без копирования содержимого
+    :param path: Путь к файлу в хранилище
+    :param suffix: Расширение файла результата
+    :return: Путь к жесткой ссылке (или копии) в OUTPUT_DIR
+    """
+    output_path = new_output_path(suffix)
+    try:
+        os.link(path, output_path)
+    except OSError:
+        shutil.copyfile(path, output_path)  # Файловая система без жестких ссылок
+    return output_path
+
+
+def save_blob(content: bytes, directory: Path, suffix: str) -> str:
+    """
+    Сохраняет содержимое в хранилище, адресуя его по sha256
+    :param content: Байтовое содержимое файла
+    :param directory: Каталог хранилища
+    :param suffix: Расширение файла
+    :return: sha256 содержимого
+    """
+    sha = hashlib.sha256(content).hexdigest()
+    path = directory / f"{sha}{suffix}"
+    if path.exists():
+        os.utime(path)  # Повторная загрузка продлевает жизнь файла
+        logger.debug(f"Blob already stored: {path.name}")
+    else:
+        directory.mkdir(parents=True, exist_ok=True)
+        # Пишем во временный файл и переименовываем, чтобы не отдать недописанный файл
+        with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as tmp:
+            tmp.write(content)
+        os.replace(tmp.name, path)
+        logger.debug(f"Stored blob: {path.name}")
+
+    remove_expired_blobs()
+    return sha
+
+
+def save_pdf(content: bytes) -> str:
+    return save_blob(content, STORAGE_DIR, ".pdf")
+
+
+def save_previews(previews: list[bytes]) -> list[str]:
+    """Сохраняет превью и возвращает их URL"""
+    return [f"{PREVIEWS_URL}/{save_blob(content, PREVIEWS_DIR, '.jpg')}.jpg" for content in previews]
+
+
+def get_cached_previews(sha: str) -> Optional[list[str]]:
+    """
+    Возвращает URL уже сохраненных превью PDF и продлевает жизнь их файлов
+    :param sha: sha256 PDF
+    :return: Список URL или None, если превью нет в кеше или их файлы уже удалены
+    """
+    with _previews_cache_lock:
+        preview_urls = _previews_cache.get(sha)
+    if preview_urls is None:
+        return None
+
+    try:
+        for url in preview_urls:
+            os.utime(PREVIEWS_DIR / url.rsplit("/", 1)[1])
+    except FileNotFoundError:
+        logger.debug(f"Cached previews for {sha} expired")
+        return None
+    return preview_urls
+
+
+def cache_previews(sha: str, preview_urls: list[str]) -> None:
+    with _previews_cache_lock:
+        _previews_cache[sha] = preview_urls
+
+
+def remove_expired_blobs() -> None:
+    """Удаляет файлы старше STORAGE_TTL, не чаще раза в CLEANUP_INTERVAL"""
+    global _last_cleanup
+    now = time.time()
+    if now - _last_cleanup < CLEANUP_INTERVAL:
+        return
+    _last_cleanup = now
+
+    removed = 0
+    # Результаты, которые не удалось отправить, тоже удаляются здесь
+    for directory in (STORAGE_DIR, PREVIEWS_DIR, OUTPUT_DIR):
+        for path in directory.glob("*.*"):
+            try:
+                if now - path.stat().st_mtime > STORAGE_TTL:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                continue  # Файл уже удалил другой процесс
+    logger.info(f"Removed {removed} expired files from storage")
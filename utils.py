@@ -1,49 +1,304 @@
+import asyncio
+import copyreg
+import multiprocessing
+import os
+import threading
 import zipfile
-from io import BytesIO
-from typing import Dict
-
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import RawIOBase
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterator, Optional
+
+import numpy as np
+import pikepdf
 import pymupdf as fitz
 from fastapi import HTTPException, Request
-from PIL import Image
-from PyPDF2 import PdfMerger, PdfReader, PdfWriter
 
+import storage
 from logger import get_logger
 
 logger = get_logger(__name__)
 
+# Сколько страниц отдается одному процессу за раз: пересылка задачи
+# в процесс дороже рендеринга одной страницы, поэтому страницы рендерятся блоками
+PAGES_PER_TASK = 4
+
+# Размер куска, которым архив отдается клиенту при потоковой передаче
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Ширина превью в пикселях: страницы крупнее уменьшаются до нее
+PREVIEW_WIDTH_PX = 400
+MIN_DPI = 72
+MAX_DPI = 600
+
+# Режимы конвертации: (максимальный DPI, качество JPEG). Для просмотра на экране
+# хватает 150 DPI, а это вчетверо меньше пикселей, чем при печатных 300
+OUTPUT_MODES = {
+    "preview": (150, 75),
+    "print": (MAX_DPI, 85),
+}
+
+# Сколько открытых документов держит каждый поток и процесс пула
+DOCUMENT_CACHE_SIZE = 8
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+_documents = threading.local()
+
+
+def _reduce_http_exception(exc: HTTPException):
+    return HTTPException, (exc.status_code, exc.detail, exc.headers)
+
+
+# HTTPException(status_code=..., detail=...) не восстанавливается через pickle:
+# ее args пусты. Ошибки из процессов пула передаются по status_code и detail
+copyreg.pickle(HTTPException, _reduce_http_exception)
+
+
+def _create_process_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context("forkserver"))
+
+
+def start_process_pool() -> ProcessPoolExecutor:
+    """
+    Создает общий для всех запросов пул процессов для тяжелой работы с PDF.
+    Вызывается один раз при старте приложения. Процессы запускаются через
+    forkserver, а не fork: запросы обращаются к пулу из рабочих потоков,
+    и копия процесса с чужими потоками и открытыми файлами пулу не нужна.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        _process_pool = _create_process_pool()
+    logger.info(f"Started process pool with {_process_pool._max_workers} workers")
+    return _process_pool
+
+
+def restart_process_pool(broken_pool: ProcessPoolExecutor) -> None:
+    """
+    Заменяет пул, в котором упал процесс (segfault в MuPDF/qpdf на битом PDF, OOM).
+    Такой пул больше не принимает задачи, поэтому без замены все следующие
+    запросы завершались бы ошибкой до перезапуска сервера.
+    :param broken_pool: Пул, на котором получен BrokenProcessPool
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not broken_pool:
+            return  # Пул уже пересоздал другой запрос
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = _create_process_pool()
+    logger.warning("Process pool was broken, restarted")
+
+
+def shutdown_process_pool() -> None:
+    """Останавливает пул процессов при завершении приложения"""
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+        logger.info("Process pool stopped")
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Возвращает пул процессов, созданный при старте приложения"""
+    if _process_pool is None:
+        raise RuntimeError("Process pool is not started")
+    return _process_pool
+
+
+def _reset_documents() -> None:
+    global _documents
+    _documents = threading.local()
+
+
+# Открытые документы делят дескриптор файла и его позицию с родителем,
+# поэтому процесс, созданный через fork, начинает с пустым кешем
+os.register_at_fork(after_in_child=_reset_documents)
+
+
+def _open_document(pdf_path: Path) -> fitz.Document:
+    """
+    Открывает PDF из хранилища, переиспользуя уже открытые документы.
+    Файлы в хранилище адресуются по хешу и не меняются, поэтому документ
+    можно не закрывать между вызовами. Кеш у каждого потока свой:
+    документ MuPDF нельзя использовать из нескольких потоков.
+    Вызывается только в процессах пула: в основном процессе открытые документы
+    держали бы удаленные из хранилища файлы, пока поток случайно их не вытеснит.
+    """
+    cache = getattr(_documents, "cache", None)
+    if cache is None:
+        cache = _documents.cache = OrderedDict()
+
+    key = str(pdf_path)
+    pdf_document = cache.get(key)
+    if pdf_document is not None:
+        cache.move_to_end(key)
+        return pdf_document
+
+    pdf_document = cache[key] = fitz.open(pdf_path)
+    if len(cache) > DOCUMENT_CACHE_SIZE:
+        _, evicted = cache.popitem(last=False)
+        evicted.close()
+    return pdf_document
+
+
+def _get_page_count(pdf_path: Path) -> int:
+    """Количество страниц PDF; документ сразу закрывается (для основного процесса)"""
+    with fitz.open(pdf_path) as pdf_document:
+        return pdf_document.page_count
+
+
+def _render_page(
+    pdf_document: fitz.Document, page_num: int, dpi: Optional[int], max_width: Optional[int] = None
+) -> fitz.Pixmap:
+    """
+    Рендерит одну страницу открытого документа в RGB pixmap
+    :param dpi: Разрешение рендеринга
+    :param max_width: Максимальная ширина в пикселях (вместо dpi, для превью)
+    """
+    page = pdf_document.load_page(page_num)
+    if max_width:
+        scale = min(1.0, max_width / page.rect.width)
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+    else:
+        pixmap = page.get_pixmap(dpi=dpi, alpha=False)
+    return pixmap
+
+
+def _render_pages_to_jpeg(
+    pdf_path: Path,
+    page_numbers: list[int],
+    dpi: Optional[int],
+    quality: int,
+    max_width: Optional[int] = None,
+) -> list[bytes]:
+    """Рендерит блок страниц PDF в JPEG (выполняется в процессе пула)"""
+    pdf_document = _open_document(pdf_path)
+    # MuPDF кодирует JPEG прямо из буфера pixmap, без копии в PIL.Image
+    return [
+        _render_page(pdf_document, page_num, dpi, max_width).tobytes("jpeg", jpg_quality=quality)
+        for page_num in page_numbers
+    ]
+
+
+def iter_rendered_pages(render_func: Callable, pdf_path: Path, page_count: int, **kwargs) -> Iterator:
+    """
+    Рендерит страницы PDF в пуле процессов блоками по PAGES_PER_TASK страниц.
+    В работе одновременно не больше блоков, чем процессов в пуле, чтобы
+    готовые страницы не копились в памяти быстрее, чем их забирают.
+    :param render_func: Функция рендеринга блока страниц (_render_pages_to_*)
+    :param pdf_path: Путь к PDF-файлу в хранилище
+    :param page_count: Количество страниц в документе
+    :return: Итератор результатов рендеринга в порядке страниц
+    """
+    chunks = [list(range(start, min(start + PAGES_PER_TASK, page_count))) for start in range(0, page_count, PAGES_PER_TASK)]
+    # Даже короткие документы рендерятся в пуле: MuPDF держит GIL во время рендеринга
+    # и кодирования, а пересылка задачи в процесс дешевле рендеринга одной страницы
+    logger.debug(f"Rendering {page_count} pages in {len(chunks)} tasks")
+    pool = get_process_pool()
+    window = os.cpu_count() or 1
+    pending = deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.submit(render_func, pdf_path, chunk, **kwargs))
+            if len(pending) >= window:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    except BrokenProcessPool:
+        logger.error("Process pool is broken, restarting it")
+        restart_process_pool(pool)
+        raise HTTPException(status_code=503, detail="Сервис временно недоступен, повторите попытку")
+    finally:
+        for future in pending:
+            future.cancel()
+
 
-def convert_pdf_to_images(pdf_bytes: bytes, quality: int = 50) -> list[bytes]:
+class StreamCancelled(Exception):
+    """Клиент перестал читать потоковый ответ: это штатная остановка, а не ошибка"""
+
+
+class QueueStream(RawIOBase):
+    """
+    Файлоподобный объект для записи из рабочего потока: накопленные байты
+    передаются в asyncio.Queue, откуда их забирает асинхронный генератор ответа.
+    Запись блокируется, пока в очереди нет места. По закрытию в очередь кладется None.
+    """
+
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._queue = queue
+        self._loop = loop
+        self._buffer = bytearray()
+        self._cancelled = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self._cancelled:
+            raise StreamCancelled("Stream consumer is gone")
+        self._buffer += data
+        if len(self._buffer) >= STREAM_CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed and not self._cancelled:
+            if self._buffer:
+                self._put(bytes(self._buffer))
+            self._put(None)
+        super().close()
+
+    def cancel(self) -> None:
+        """Вызывается из event loop, когда ответ больше не читают: освобождает ждущего писателя"""
+        self._cancelled = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    def _put(self, item: Optional[bytes]) -> None:
+        asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop).result()
+
+
+def convert_pdf_to_images(pdf_path: Path, quality: int = 50) -> list[bytes]:
     """
     Конвертирует страницы PDF в список байтов изображений JPEG.
-    :param pdf_bytes: Байтовые данные PDF-файла
+    :param pdf_path: Путь к PDF-файлу в хранилище
     :param quality: Уровень качества JPEG (0-100)
     :return: Список байтовых строк с изображениями
     """
     logger.info(f"Starting PDF to images conversion, quality: {quality}")
     try:
-        pdf_document = fitz.open(stream=BytesIO(pdf_bytes))
-        images = []
-        logger.debug(f"Processing PDF with {len(pdf_document)} pages")
-
-        for page_num in range(len(pdf_document)):
-            logger.debug(f"Processing page {page_num + 1}")
-            page = pdf_document.load_page(page_num)
-            pixmap = page.get_pixmap()
-            img = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
+        page_count = _get_page_count(pdf_path)
+        logger.debug(f"Processing PDF with {page_count} pages")
 
-            image_buffer = BytesIO()
-            img.save(image_buffer, format="JPEG", quality=quality, optimize=True)
-            images.append(image_buffer.getvalue())
+        images = list(
+            iter_rendered_pages(
+                _render_pages_to_jpeg, pdf_path, page_count, dpi=None, quality=quality, max_width=PREVIEW_WIDTH_PX
+            )
+        )
 
         logger.info(f"Successfully converted {len(images)} pages to JPEG")
         return images
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error converting PDF to images: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error converting PDF to images: {str(e)}")
 
 
-def parse_page_ranges(pages: str) -> list[int]:
-    """Парсит строку с диапазонами страниц в список номеров страниц"""
+def parse_page_ranges(pages: str, page_count: int) -> list[int]:
+    """
+    Парсит строку с диапазонами страниц в список 0-based номеров страниц
+    :param pages: Строка с номерами страниц (например, "1-3,5,7-9")
+    :param page_count: Количество страниц в документе
+    :return: Отсортированный список номеров без повторов
+    :raises ValueError: При некорректном формате
+    :raises IndexError: Если страница выходит за пределы документа (номер страницы в args[0])
+    """
     logger.debug(f"Parsing page ranges: {pages}")
     page_ranges = []
     try:
@@ -51,66 +306,76 @@ def parse_page_ranges(pages: str) -> list[int]:
             part = part.strip()
             if "-" in part:
                 start, end = map(int, part.split("-"))
-                page_ranges.extend(range(start - 1, end))  # -1 для 0-based индекса
             else:
-                page_ranges.append(int(part) - 1)
-        return sorted(list(set(page_ranges)))  # Удаляем дубликаты и сортируем
+                start = end = int(part)
+            if start > end:
+                continue  # Пустой диапазон
+            # Границы проверяются до построения массива: "1-2000000000" не должен выделять гигабайты
+            if start < 1:
+                raise IndexError(start)
+            if end > page_count:
+                raise IndexError(max(start, page_count + 1))
+            page_ranges.append(np.arange(start - 1, end, dtype=np.int64))  # -1 для 0-based индекса
+        return np.unique(np.concatenate(page_ranges)).tolist()  # Удаляем дубликаты и сортируем за один проход в C
     except ValueError as e:
         logger.error(f"Invalid page range format: {pages} - {str(e)}")
         raise
 
 
-def split_pdf(file_content: bytes, pages: str) -> BytesIO:
+def split_pdf(pdf_path: Path, pages: str) -> Path:
     """
     Разделяет PDF по заданным страницам
-    :param file_content: Байтовое содержимое PDF
+    :param pdf_path: Путь к PDF-файлу в хранилище
     :param pages: Строка с номерами страниц (например, "1-3,5,7-9")
-    :return: BytesIO поток с результирующим PDF
+    :return: Путь к временному файлу с результирующим PDF
     :raises HTTPException: При ошибках обработки
     """
     logger.info(f"Splitting PDF with pages: {pages}")
+    output_path = storage.new_output_path(".pdf")
     try:
-        page_numbers = parse_page_ranges(pages)
-        logger.debug(f"Parsed page numbers: {page_numbers}")
-    except ValueError:
-        logger.error(f"Invalid page range format: {pages}")
-        raise HTTPException(status_code=400, detail="Некорректный формат номеров страниц")
-
-    try:
-        pdf_reader = PdfReader(BytesIO(file_content))
-        logger.debug(f"PDF has {len(pdf_reader.pages)} pages total")
-        pdf_writer = PdfWriter()
-
-        for page_num in page_numbers:
-            if 0 <= page_num < len(pdf_reader.pages):
-                pdf_writer.add_page(pdf_reader.pages[page_num])
-            else:
-                logger.warning(f"Page {page_num + 1} out of range (max {len(pdf_reader.pages)})")
-                raise HTTPException(status_code=400, detail=f"Страница {page_num + 1} не существует в документе")
-
-        output_stream = BytesIO()
-        pdf_writer.write(output_stream)
-        output_stream.seek(0)
+        with pikepdf.open(pdf_path) as src, pikepdf.new() as dst:
+            page_count = len(src.pages)
+            logger.debug(f"PDF has {page_count} pages total")
+
+            try:
+                page_numbers = parse_page_ranges(pages, page_count)
+            except ValueError:
+                logger.error(f"Invalid page range format: {pages}")
+                raise HTTPException(status_code=400, detail="Некорректный формат номеров страниц")
+            except IndexError as e:
+                logger.warning(f"Page {e.args[0]} out of range (max {page_count})")
+                raise HTTPException(status_code=400, detail=f"Страница {e.args[0]} не существует в документе")
+            # Список может быть на тысячи страниц: форматируем его, только если DEBUG включен
+            logger.debug("Parsed page numbers: %s", page_numbers)
+
+            for page_num in page_numbers:
+                dst.pages.append(src.pages[page_num])
+
+            dst.save(output_path)
         logger.info(f"Successfully split PDF into {len(page_numbers)} pages")
-        return output_stream
+        return output_path
     except HTTPException:
+        output_path.unlink(missing_ok=True)
         raise
     except Exception as e:
+        output_path.unlink(missing_ok=True)
         logger.error(f"Error splitting PDF: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при обработке PDF: {str(e)}")
 
 
-def merge_pdfs(filenames: list[str], session_files: dict) -> BytesIO:
+def merge_pdfs(filenames: list[str], session_files: dict) -> Path:
     """
     Объединяет несколько PDF из сессии в один
     :param filenames: Список имен файлов для объединения
     :param session_files: Словарь файлов из сессии {filename: file_data}
-    :return: BytesIO поток с объединенным PDF
+    :return: Путь к временному файлу с объединенным PDF
     :raises HTTPException: Если файлы не найдены
     """
     logger.info(f"Merging PDFs: {filenames}")
-    merger = PdfMerger()
-    output = BytesIO()
+    merged = pikepdf.new()
+    # Исходные документы должны оставаться открытыми до сохранения результата
+    sources = []
+    output_path = storage.new_output_path(".pdf")
 
     try:
         # Проверяем наличие всех файлов
@@ -119,32 +384,38 @@ def merge_pdfs(filenames: list[str], session_files: dict) -> BytesIO:
             logger.warning(f"Missing files: {missing_files}")
             raise HTTPException(status_code=404, detail=f"Файлы не найдены: {', '.join(missing_files)}")
 
-        # Добавляем файлы в merger
+        # Добавляем страницы файлов в результирующий документ
         for filename in filenames:
             logger.debug(f"Adding file to merge: {filename}")
             file_data = session_files[filename]
-            merger.append(BytesIO(file_data["file_content"]))
+            src = pikepdf.open(storage.pdf_path(file_data["sha"]))
+            sources.append(src)
+            merged.pages.extend(src.pages)
 
-        merger.write(output)
-        output.seek(0)
+        # Объектные потоки дают компактный результат, линеаризация только замедлила бы сохранение
+        merged.save(output_path, linearize=False, object_stream_mode=pikepdf.ObjectStreamMode.generate)
         logger.info(f"Successfully merged {len(filenames)} PDFs")
-        return output
+        return output_path
     except HTTPException:
+        output_path.unlink(missing_ok=True)
         raise
     except Exception as e:
+        output_path.unlink(missing_ok=True)
         logger.error(f"Error merging PDFs: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при объединении PDF: {str(e)}")
     finally:
-        merger.close()
-        logger.debug("PDF merger closed")
+        merged.close()
+        for src in sources:
+            src.close()
+        logger.debug("PDF documents closed")
 
 
-def get_files_from_session(request: Request, filenames: list[str]) -> Dict[str, bytes]:
+def get_files_from_session(request: Request, filenames: list[str]) -> Dict[str, Path]:
     """
     Получает файлы из сессии по именам
     :param request: FastAPI Request объект
     :param filenames: Список имен файлов
-    :return: Словарь {имя_файла: содержимое_файла}
+    :return: Словарь {имя_файла: путь_к_файлу}
     :raises HTTPException: Если файлы не найдены
     """
     logger.info(f"Getting files from session: {filenames}")
@@ -158,12 +429,12 @@ def get_files_from_session(request: Request, filenames: list[str]) -> Dict[str,
                 logger.warning(f"File not found in session: {filename}")
                 raise HTTPException(status_code=404, detail=f"Файл '{filename}' не найден в сессии")
 
-            file_content = session_files[filename].get("file_content")
-            if not file_content:
+            file_sha = session_files[filename].get("sha")
+            if not file_sha or not storage.pdf_path(file_sha).exists():
                 logger.warning(f"No content for file: {filename}")
                 raise HTTPException(status_code=400, detail=f"Отсутствует содержимое файла '{filename}'")
 
-            result[filename] = file_content
+            result[filename] = storage.pdf_path(file_sha)
             logger.debug(f"Added file to result: {filename}")
 
         logger.info(f"Successfully retrieved {len(result)} files from session")
@@ -175,73 +446,37 @@ def get_files_from_session(request: Request, filenames: list[str]) -> Dict[str,
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
-def convert_pdf_to_jpeg(file_content: bytes, dpi: int = 300) -> list[Image.Image]:
+def convert_and_pack(files: Dict[str, Path], output: BinaryIO, dpi: int = 300, output_mode: str = "print") -> None:
     """
-    Конвертирует PDF в список изображений JPEG
-    :param file_content: Байтовое содержимое PDF
+    Конвертирует PDF в JPEG и постранично записывает их в один ZIP-архив
+    :param files: Словарь {имя_файла: путь_к_файлу}
+    :param output: Файлоподобный объект, в который пишется архив
     :param dpi: Разрешение изображений
-    :return: Список объектов PIL.Image
-    """
-    logger.info(f"Converting PDF to JPEG with DPI: {dpi}")
-    try:
-        doc = fitz.open(stream=BytesIO(file_content))
-        images = []
-        logger.debug(f"PDF has {doc.page_count} pages")
-
-        for page_num in range(doc.page_count):
-            logger.debug(f"Converting page {page_num + 1}")
-            page = doc.load_page(page_num)
-            pixmap = page.get_pixmap(dpi=dpi)
-            img = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
-            images.append(img)
-
-        logger.info(f"Successfully converted {len(images)} pages to JPEG")
-        return images
-    except Exception as e:
-        logger.error(f"Error converting PDF to JPEG: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error converting PDF to JPEG: {str(e)}")
-
-
-def pack_images_into_zip(images: list[Image.Image], prefix: str) -> BytesIO:
-    """
-    Упаковывает изображения в ZIP-архив
-    :param images: Список изображений PIL.Image
-    :param prefix: Префикс для имен файлов
-    :return: BytesIO поток с ZIP-архивом
+    :param output_mode: Режим из OUTPUT_MODES ("preview" или "print")
     """
-    logger.info(f"Packing {len(images)} images into ZIP with prefix: {prefix}")
-    try:
-        buffer = BytesIO()
-        with zipfile.ZipFile(buffer, "w") as zf:
-            for idx, img in enumerate(images, start=1):
-                img_bytes = BytesIO()
-                img.save(img_bytes, format="JPEG", quality=85)
-                filename = f"{prefix}_page_{idx}.jpg"
-                zf.writestr(filename, img_bytes.getvalue())
-                logger.debug(f"Added image to ZIP: {filename}")
-
-        buffer.seek(0)
-        logger.info(f"Successfully created ZIP archive with {len(images)} images")
-        return buffer
-    except Exception as e:
-        logger.error(f"Error packing images to ZIP: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error packing images to ZIP: {str(e)}")
-
+    if not MIN_DPI <= dpi <= MAX_DPI:
+        logger.warning(f"DPI {dpi} out of range, clamping to {MIN_DPI}-{MAX_DPI}")
+        dpi = max(MIN_DPI, min(dpi, MAX_DPI))
+    max_dpi, quality = OUTPUT_MODES[output_mode]
+    dpi = min(dpi, max_dpi)
 
-def convert_and_pack(filename: str, file_content: bytes, dpi: int = 300) -> BytesIO:
-    """
-    Конвертирует PDF в JPEG и упаковывает в ZIP
-    :param filename: Имя исходного файла
-    :param file_content: Байтовое содержимое PDF
-    :param dpi: Разрешение изображений
-    :return: BytesIO поток с ZIP-архивом
-    """
-    logger.info(f"Converting and packing PDF: {filename}, DPI: {dpi}")
+    logger.info(f"Converting and packing {len(files)} PDFs, DPI: {dpi}, mode: {output_mode}")
     try:
-        images = convert_pdf_to_jpeg(file_content, dpi)
-        prefix = filename.rsplit(".", 1)[0]  # Удаляем расширение
-        logger.debug(f"Using prefix for ZIP: {prefix}")
-        return pack_images_into_zip(images, prefix)
+        # JPEG уже сжат, поэтому deflate только тратит CPU
+        with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED) as zf:
+            for idx, (filename, file_path) in enumerate(files.items(), start=1):
+                prefix = filename.rsplit(".", 1)[0]  # Удаляем расширение
+                page_count = _get_page_count(file_path)
+                logger.debug(f"Converting {filename}: {page_count} pages, prefix: {prefix}")
+
+                pages = iter_rendered_pages(_render_pages_to_jpeg, file_path, page_count, dpi=dpi, quality=quality)
+                for page_num, jpeg_bytes in enumerate(pages, start=1):
+                    zf.writestr(f"file_{idx}/{prefix}_page_{page_num}.jpg", jpeg_bytes)
+
+        logger.info(f"Successfully converted and packed {len(files)} PDFs")
+    except StreamCancelled:
+        logger.info("Client disconnected, conversion stopped")
+        raise
     except HTTPException:
         raise
     except Exception as e:
@@ -249,68 +484,55 @@ def convert_and_pack(filename: str, file_content: bytes, dpi: int = 300) -> Byte
         raise HTTPException(status_code=500, detail=f"Error processing PDF: {str(e)}")
 
 
-def combine_archives(individual_archives: list[BytesIO]) -> BytesIO:
-    """
-    Объединяет несколько ZIP-архивов в один
-    :param individual_archives: Список BytesIO потоков с ZIP-архивами
-    :return: BytesIO поток с объединенным ZIP-архивом
-    """
-    logger.info(f"Combining {len(individual_archives)} ZIP archives")
-    try:
-        buffer = BytesIO()
-        with zipfile.ZipFile(buffer, "w") as zf:
-            for idx, archive in enumerate(individual_archives, start=1):
-                archive.seek(0)
-                with zipfile.ZipFile(archive) as src_zip:
-                    for name in src_zip.namelist():
-                        new_name = f"file_{idx}/{name}"
-                        zf.writestr(new_name, src_zip.read(name))
-                        logger.debug(f"Added file to combined ZIP: {new_name}")
-
-        buffer.seek(0)
-        logger.info(f"Successfully combined {len(individual_archives)} archives")
-        return buffer
-    except Exception as e:
-        logger.error(f"Error combining archives: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error combining archives: {str(e)}")
-
-
-def rotate_pages_in_pdf(file_content: bytes, rotations: list[tuple[int, int]]) -> BytesIO:
+def rotate_pages_in_pdf(pdf_path: Path, rotations: list[tuple[int, int]]) -> Path:
     """
     Поворачивает указанные страницы PDF на указанные углы
-    :param file_content: Байтовое содержимое PDF
+    :param pdf_path: Путь к PDF-файлу в хранилище
     :param rotations: Список кортежей (номер_страницы, угол_поворота)
                      где номер_страницы начинается с 1 (1-based)
-                     угол_поворота может быть 0, 90, 180 или 270 градусов
-    :return: BytesIO поток с результатом
+                     угол_поворота - целое число, кратное 90 градусам
+    :return: Путь к временному файлу с результатом
+    :raises HTTPException: При недопустимом угле или ошибках обработки
     """
-    logger.info(f"Rotating PDF pages: {rotations}")
+    logger.info(f"Rotating {len(rotations)} PDF pages")
+    for page_num, angle in rotations:
+        # /Rotate по спецификации PDF - целое, кратное 90
+        if not isinstance(angle, int) or isinstance(angle, bool) or angle % 90 != 0:
+            logger.warning(f"Invalid rotation angle for page {page_num}: {angle}")
+            raise HTTPException(status_code=400, detail=f"Недопустимый угол поворота: {angle}")
+
+    # Словарь оставляет последний угол для повторяющихся страниц; полные обороты ничего не меняют
+    rotations_dict = {page_num: angle % 360 for page_num, angle in rotations}
+    rotations_dict = {page_num: angle for page_num, angle in rotations_dict.items() if angle}
+    logger.debug("Rotations dictionary: %s", rotations_dict)
+
+    if not rotations_dict:
+        # Документ не меняется: не разбираем и не пересохраняем его
+        logger.info("No pages to rotate, returning original PDF")
+        return storage.link_output(pdf_path, ".pdf")
+
+    output_path = storage.new_output_path(".pdf")
     try:
-        reader = PdfReader(BytesIO(file_content))
-        writer = PdfWriter()
-        logger.debug(f"PDF has {len(reader.pages)} pages")
-
-        # Создаем словарь для быстрого доступа к углам поворота
-        rotations_dict = {page_num: angle for page_num, angle in rotations}
-        logger.debug(f"Rotations dictionary: {rotations_dict}")
-
-        rotated_pages = 0
-        for i, page in enumerate(reader.pages):
-            page_num = i + 1  # Преобразуем в 1-based индекс
-            if page_num in rotations_dict:
-                angle = rotations_dict[page_num]
-                if angle != 0:  # Поворачиваем только если угол не 0
-                    page.rotate(angle)
-                    rotated_pages += 1
-                    logger.debug(f"Rotated page {page_num} by {angle} degrees")
-
-            writer.add_page(page)
-
-        output_stream = BytesIO()
-        writer.write(output_stream)
-        output_stream.seek(0)
+        # pikepdf меняет документ на месте, копировать страницы в новый документ не нужно
+        with pikepdf.open(pdf_path) as pdf:
+            page_count = len(pdf.pages)
+            logger.debug(f"PDF has {page_count} pages")
+
+            # Обходим только поворачиваемые страницы, остальные не трогаем
+            rotated_pages = 0
+            for page_num, angle in rotations_dict.items():
+                if not 1 <= page_num <= page_count:
+                    logger.warning(f"Page {page_num} out of range (max {page_count}), skipping rotation")
+                    continue
+
+                page = pdf.pages[page_num - 1].obj  # Преобразуем в 0-based индекс
+                page.Rotate = (int(page.get("/Rotate", 0)) + angle) % 360
+                rotated_pages += 1
+
+            pdf.save(output_path)
         logger.info(f"Successfully rotated {rotated_pages} pages")
-        return output_stream
+        return output_path
     except Exception as e:
+        output_path.unlink(missing_ok=True)
         logger.error(f"Error rotating PDF pages: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка при повороте страниц: {str(e)}")
\ No newline at end of file
@@ -4,6 +4,7 @@ import requests
 from dataclasses import dataclass, asdict
 from typing import Optional
 
+from cachetools.func import ttl_cache
 from fastapi import Request
 
 @dataclass
@@ -18,9 +19,23 @@ class Visit:
     is_new_user: Optional[bool] = None
 
 
+# Визиты в основном идут с небольшого числа повторяющихся IP
+IP_INFO_CACHE_SIZE = 10_000
+IP_INFO_TTL = 60 * 60
+
+# Общая сессия держит соединения открытыми: без нее каждый визит делает новый TCP+TLS handshake
+http_session = requests.Session()
+
+
+@ttl_cache(maxsize=IP_INFO_CACHE_SIZE, ttl=IP_INFO_TTL)
+def _fetch_ip_info(ip: str) -> dict:
+    """Ответ ip-api.com; ошибки не кешируются, так как пробрасываются наружу"""
+    return http_session.get(url=f"http://ip-api.com/json/{ip}", timeout=5).json()
+
+
 def get_info_by_ip(ip: str, logger: Logger) -> Optional[Visit]:
     try:
-        response = requests.get(url=f"http://ip-api.com/json/{ip}", timeout=5).json()
+        response = _fetch_ip_info(ip)
         ip = response.get("query")
 
         return Visit(
@@ -39,7 +54,7 @@ def get_info_by_ip(ip: str, logger: Logger) -> Optional[Visit]:
 
 
 def send_visit_info(request: Request, logger: Logger) -> Optional[dict]:
-    """Основная функция для отправки визита"""
+    """Основная функция для отправки визита (выполняется в фоне, после ответа пользователю)"""
     user_ip = request.client.host
     user_data = get_info_by_ip(user_ip, logger)
 
@@ -52,7 +67,7 @@ def send_visit_info(request: Request, logger: Logger) -> Optional[dict]:
     visit_data = asdict(user_data)
 
     try:
-        response = requests.post(
+        response = http_session.post(
             url,
             json=visit_data,
             headers=headers,